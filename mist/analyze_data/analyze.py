@@ -350,6 +350,7 @@ class Analyzer:
             "global_z_score_mean": None,
             "global_z_score_std": None,
             "use_n4_bias_correction": None,
+            "n4_shrink_factor": None,
             "median_image_size": None,
             "class_weights": None
         }
@@ -381,6 +382,7 @@ class Analyzer:
                     ct_normalization_parameters["ct_global_z_score_std"]
                 ),
                 "use_n4_bias_correction": bool(False),
+                "n4_shrink_factor": None,
             }
             self.config.update(configuration_with_ct_parameters)
         else:
@@ -389,6 +391,7 @@ class Analyzer:
                 "use_n4_bias_correction": bool(
                     self.mist_arguments.use_n4_bias_correction
                 ),
+                "n4_shrink_factor": int(self.mist_arguments.n4_shrink_factor),
             }
             self.config.update(configuration_no_ct_parameters)
 
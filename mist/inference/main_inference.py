@@ -415,6 +415,14 @@ def test_on_fold(
     model.eval()
     model.to("cuda")
 
+    # Compile the model if enabled. The patch size is fixed during sliding
+    # window inference, so CUDA graphs captured in "reduce-overhead" mode are
+    # reused for every window. Graphs that fail to compile run eagerly with a
+    # warning.
+    if args.compile:
+        utils.enable_compile_eager_fallback(warn=True)
+        model = torch.compile(model, mode="reduce-overhead", fullgraph=False)
+
     # Progress bar and error messages.
     progress_bar = utils.get_progress_bar(f'Testing on fold {fold_number}')
     console = rich.console.Console()
@@ -555,14 +563,15 @@ def test_time_inference(
                 image_list = list(patient.values())[start_column_index:]
                 og_ants_img = ants.image_read(image_list[0])
 
+                # Pass the first image through since we already read it.
                 if no_preprocess:
                     preprocessed_example = preprocess.convert_nifti_to_numpy(
-                        image_list
+                        [og_ants_img, *image_list[1:]]
                     )
                 else:
                     preprocessed_example = preprocess.preprocess_example(
                         config,
-                        image_list,
+                        [og_ants_img, *image_list[1:]],
                     )
 
                 # Make image channels first and add batch dimension.
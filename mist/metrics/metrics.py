@@ -280,14 +280,14 @@ def compute_surface_distances(
             ~borders_gt, sampling=spacing_mm
         )
     else:
-        distmap_gt = np.Inf * np.ones(borders_gt.shape) # type: ignore
+        distmap_gt = np.inf * np.ones(borders_gt.shape) # type: ignore
 
     if borders_pred.any():
         distmap_pred = ndimage.morphology.distance_transform_edt( # type: ignore
             ~borders_pred, sampling=spacing_mm
         )
     else:
-        distmap_pred = np.Inf * np.ones(borders_pred.shape) # type: ignore
+        distmap_pred = np.inf * np.ones(borders_pred.shape) # type: ignore
 
     # Compute the area of each surface element.
     surface_area_map_gt = neighbour_code_to_surface_area[neighbour_code_map_gt]
@@ -385,7 +385,7 @@ def compute_robust_hausdorff(
             min(idx.astype("int"), len(distances_gt_to_pred) - 1)
         ]
     else:
-        perc_distance_gt_to_pred = np.Inf # type: ignore
+        perc_distance_gt_to_pred = np.inf # type: ignore
 
     if len(distances_pred_to_gt) > 0:
         surfel_areas_cum_pred = (
@@ -396,7 +396,7 @@ def compute_robust_hausdorff(
             min(idx.astype("int"), len(distances_pred_to_gt) - 1)
         ]
     else:
-        perc_distance_pred_to_gt = np.Inf # type: ignore
+        perc_distance_pred_to_gt = np.inf # type: ignore
 
     # Return max of the two one-sided Hausdorff distances.
     return np.max(
@@ -504,7 +504,7 @@ def compute_dice_coefficient(
 
     # Return a NaN if both masks are empty.
     if volume_sum == 0:
-        return np.NaN # type: ignore
+        return np.nan # type: ignore
 
     # Compute intersection and return the dice coefficient.
     volume_intersect = (mask_gt & mask_pred).sum()
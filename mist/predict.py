@@ -4,7 +4,7 @@ from argparse import ArgumentDefaultsHelpFormatter, ArgumentParser
 import torch
 
 from mist.runtime.args import non_negative_int, float_0_1, ArgParser
-from mist.runtime.utils import set_warning_levels
+from mist.runtime.utils import enable_compile_eager_fallback, set_warning_levels
 
 from mist.inference.main_inference import (
     check_test_time_input,
@@ -35,6 +35,7 @@ def get_predict_args():
     p.boolean_flag("--tta", default=False, help="Use test time augmentation")
     p.boolean_flag("--no-preprocess", default=False, help="Turn off preprocessing")
     p.boolean_flag("--output-std", default=False, help="Outputs standard deviation image")
+    p.boolean_flag("--compile", default=False, help="Compile the models with torch.compile for inference")
 
     args = p.parse_args()
     return args
@@ -55,6 +56,14 @@ def main(args):
     models = [model.eval() for model in models]
     models = [model.to("cuda") for model in models]
 
+    # Compile models for faster sliding window inference
+    if args.compile:
+        enable_compile_eager_fallback(warn=True)
+        models = [
+            torch.compile(model, mode="reduce-overhead", fullgraph=False)
+            for model in models
+        ]
+
     with torch.no_grad():
         test_time_inference(df,
                             args.output,
@@ -1,6 +1,8 @@
 """Preprocessing functions for medical images and masks."""
 import os
 import argparse
+import concurrent.futures
+import multiprocessing
 from typing import Dict, List, Tuple, Any, Optional, Union
 
 import ants
@@ -9,6 +11,7 @@ import numpy.typing as npt
 import pandas as pd
 import rich
 import SimpleITK as sitk
+import torch
 
 from mist.runtime import utils
 from mist.preprocess_data import preprocessing_constants
@@ -81,6 +84,73 @@ def resample_image(
     return utils.sitk_to_ants(img_sitk)
 
 
+def resample_image_gpu(
+        img_ants: ants.core.ants_image.ANTsImage,
+        target_spacing: Tuple[float, float, float],
+        new_size: Optional[Tuple[int, int, int]]=None,
+) -> ants.core.ants_image.ANTsImage:
+    """Resample an image to a target spacing on the GPU.
+
+    This uses trilinear interpolation with PyTorch on the same output grid as
+    resample_image. Anisotropic images need an intermediate resampling step, so
+    we fall back to resample_image for them or if no GPU is available.
+
+    Args:
+        img_ants: Image as ANTs image.
+        target_spacing: Target spacing as a tuple.
+        new_size: New size of the image as a tuple or None.
+
+    Returns:
+        Resampled image as ANTs image.
+    """
+    if (
+        not torch.cuda.is_available() or
+        utils.check_anisotropic(utils.ants_to_sitk(img_ants))["is_anisotropic"]
+    ):
+        return resample_image(img_ants, target_spacing, new_size)
+
+    # Get new size if not provided.
+    if new_size is None:
+        new_size = utils.get_resampled_image_dimensions(
+            img_ants.shape, img_ants.spacing, target_spacing
+        )
+
+    # Compute the sampling grid. Voxel i in the output image sits at voxel
+    # i * target_spacing / spacing in the input image, which is the same grid
+    # used by resample_image. We normalize the grid to [-1, 1] for grid_sample.
+    # The image is indexed as (x, y, z), but grid_sample expects the grid
+    # coordinates in the order (z, y, x).
+    grid = torch.meshgrid(
+        *[
+            torch.arange(new_size[i], device="cuda", dtype=torch.float32) *
+            (2 * target_spacing[i] / img_ants.spacing[i]) /
+            max(img_ants.shape[i] - 1, 1) - 1
+            for i in range(3)
+        ],
+        indexing="ij",
+    )
+    grid = torch.stack(grid[::-1], dim=-1).unsqueeze(0)
+
+    # Resample the image with trilinear interpolation. Points outside of the
+    # input image get a value of zero.
+    image = torch.from_numpy(img_ants.numpy().astype(np.float32)).to("cuda")
+    image = torch.nn.functional.grid_sample(
+        image[None, None],
+        grid,
+        mode="bilinear",
+        padding_mode="zeros",
+        align_corners=True,
+    )[0, 0].cpu().numpy()
+
+    # Convert the resampled image back to ANTs image.
+    return ants.from_numpy(
+        data=image,
+        origin=img_ants.origin,
+        spacing=tuple(target_spacing),
+        direction=img_ants.direction,
+    )
+
+
 def resample_mask(
         mask_ants: ants.core.ants_image.ANTsImage,
         labels: List[int],
@@ -102,54 +172,54 @@ def resample_mask(
         ValueError: If the low resolution axis is not an integer when
             resampling an anisotropic mask.
     """
-    # Get mask as a series of onehot encoded series of sitk images.
-    masks_sitk = utils.make_onehot(mask_ants, labels)
+    # Get mask as a onehot encoded vector image, with one component per label.
+    # This lets us resample all of the labels in a single pass.
+    mask_sitk = sitk.Compose(utils.make_onehot(mask_ants, labels))
     if new_size is None:
         new_size = utils.get_resampled_image_dimensions(
-            masks_sitk[0].GetSize(), masks_sitk[0].GetSpacing(), target_spacing
+            mask_sitk.GetSize(), mask_sitk.GetSpacing(), target_spacing
         )
 
-    # Check if the mask is anisotropic. Only do this for the first mask.
-    anisotropic_results = utils.check_anisotropic(masks_sitk[0])
-
-    # Resample each mask in the series. If the mask is anisotropic, we
-    # need to use an intermediate resampling step to avoid artifacts. This
-    # step uses nearest neighbor interpolation to resample the mask to its
-    # new size along the low resolution axis.
-    for i in range(len(labels)):
-        if anisotropic_results["is_anisotropic"]:
-            if not isinstance(anisotropic_results["low_resolution_axis"], int):
-                raise ValueError(
-                    "The low resolution axis must be an integer."
-                )
-            masks_sitk[i] = utils.aniso_intermediate_resample(
-                masks_sitk[i],
-                new_size,
-                target_spacing,
-                anisotropic_results["low_resolution_axis"]
+    # Check if the mask is anisotropic. If the mask is anisotropic, we need to
+    # use an intermediate resampling step to avoid artifacts. This step uses
+    # nearest neighbor interpolation to resample the mask to its new size along
+    # the low resolution axis.
+    anisotropic_results = utils.check_anisotropic(mask_sitk)
+    if anisotropic_results["is_anisotropic"]:
+        if not isinstance(anisotropic_results["low_resolution_axis"], int):
+            raise ValueError(
+                "The low resolution axis must be an integer."
             )
-
-        # Use linear interpolation for each mask in the series. We use
-        # linear interpolation to avoid artifacts in the mask.
-        masks_sitk[i] = sitk.Resample(
-            masks_sitk[i],
-            size=np.array(new_size).tolist(),
-            transform=sitk.Transform(),
-            interpolator=sitk.sitkLinear,
-            outputOrigin=masks_sitk[i].GetOrigin(),
-            outputSpacing=target_spacing,
-            outputDirection=masks_sitk[i].GetDirection(),
-            defaultPixelValue=0,
-            outputPixelType=masks_sitk[i].GetPixelID()
+        mask_sitk = utils.aniso_intermediate_resample(
+            mask_sitk,
+            new_size,
+            target_spacing,
+            anisotropic_results["low_resolution_axis"]
         )
 
-    # Use the argmax function to join the masks into a single mask.
-    mask = utils.sitk_to_ants(sitk.JoinSeries(masks_sitk))
-    mask = mask.numpy()
-    mask = np.argmax(mask, axis=-1)
+    # Use linear interpolation for each label in the onehot encoded mask. We
+    # use linear interpolation to avoid artifacts in the mask. The onehot
+    # encoded mask is stored as uint8, so only the interpolated output is
+    # float32.
+    mask_sitk = sitk.Resample(
+        mask_sitk,
+        size=np.array(new_size).tolist(),
+        transform=sitk.Transform(),
+        interpolator=sitk.sitkLinear,
+        outputOrigin=mask_sitk.GetOrigin(),
+        outputSpacing=target_spacing,
+        outputDirection=mask_sitk.GetDirection(),
+        defaultPixelValue=0,
+        outputPixelType=sitk.sitkVectorFloat32
+    )
+
+    # Use the argmax function over the labels to get a single mask. SimpleITK
+    # arrays are indexed as (z, y, x, label), so we transpose the result back
+    # to the (x, y, z) order used by ANTs.
+    mask = np.argmax(sitk.GetArrayViewFromImage(mask_sitk), axis=-1).T
 
     # Set the target spacing, origin, and direction for the mask.
-    mask = ants.from_numpy(data=mask.astype(np.float32))
+    mask = ants.from_numpy(data=mask.astype(np.uint8))
     mask.set_spacing(target_spacing)
     mask.set_origin(mask_ants.origin)
     mask.set_direction(mask_ants.direction)
@@ -157,6 +227,48 @@ def resample_mask(
     return mask
 
 
+def n4_bias_field_correction(
+        img_ants: ants.core.ants_image.ANTsImage,
+        shrink_factor: int,
+) -> ants.core.ants_image.ANTsImage:
+    """Apply N4 bias field correction to an image.
+
+    The bias field is smooth, so we estimate it on a downsampled copy of the
+    image and a coarse foreground mask, then evaluate it at the full
+    resolution. The N4 filter uses SimpleITK's global default number of
+    threads.
+
+    Args:
+        img_ants: Image as ANTs image.
+        shrink_factor: Factor to downsample the image by along each axis when
+            estimating the bias field.
+
+    Returns:
+        Bias corrected image as ANTs image.
+    """
+    img_sitk = sitk.Cast(utils.ants_to_sitk(img_ants), sitk.sitkFloat32)
+
+    # Get a coarse foreground mask with Otsu thresholding. The bias field is
+    # only estimated from voxels inside this mask.
+    mask_sitk = sitk.OtsuThreshold(img_sitk, 0, 1, 200)
+
+    # Estimate the bias field on the downsampled image and mask.
+    shrink_factors = [shrink_factor] * img_sitk.GetDimension()
+    corrector = sitk.N4BiasFieldCorrectionImageFilter()
+    corrector.Execute(
+        sitk.Shrink(img_sitk, shrink_factors),
+        sitk.Shrink(mask_sitk, shrink_factors),
+    )
+
+    # Evaluate the log bias field at full resolution and divide it out of the
+    # original image.
+    log_bias_field = corrector.GetLogBiasFieldAsImage(img_sitk)
+    img_sitk = img_sitk / sitk.Exp(log_bias_field)
+
+    # Convert the corrected image back to ANTs image.
+    return utils.sitk_to_ants(img_sitk)
+
+
 def window_and_normalize(
         image: npt.NDArray[Any],
         config: Dict[str, Any],
@@ -172,14 +284,18 @@ def window_and_normalize(
     Returns:
         Normalized image as a numpy array.
     """
+    # Work on a float32 copy of the image so that the windowing and
+    # normalization below can be done in place without extra temporary arrays.
+    image = image.astype(np.float32)
+
     # Get the nonzero values in the image if necessary. In the case that the
     # images in a dataset are sparse enough, we may want to only normalize
     # the nonzero values. Additionally, we will only use the nonzero values
     # to compute the mean and standard deviation if not already given as
     # global parameters (i.e, for CT images).
     if config["use_nz_mask"]:
-        nonzero_mask = (image != 0).astype(np.float32)
-        nonzeros = image[nonzero_mask != 0]
+        nonzero_mask = image != 0
+        nonzeros = image[nonzero_mask]
 
     # Normalize the image based on the modality.
     # For CT images, we use precomputed window ranges and normalization
@@ -194,49 +310,35 @@ def window_and_normalize(
         std = config["global_z_score_std"]
     else:
         # For all other modalities, we clip with the 0.5 and 99.5 percentiles
-        # values of either the entire image or the nonzero values.
-        if config["use_nz_mask"]:
-            # Compute the window range based on the 0.5 and 99.5 percentiles
-            # of the nonzero values.
-            lower = np.percentile(
-                nonzeros,
-                preprocessing_constants.PreprocessingConstants.WINDOW_PERCENTILE_LOW
-            )
-            upper = np.percentile(
-                nonzeros,
-                preprocessing_constants.PreprocessingConstants.WINDOW_PERCENTILE_HIGH
-            )
-
-            # Compute the mean and standard deviation of the nonzero values.
-            mean = np.mean(nonzeros)
-            std = np.std(nonzeros)
-        else:
-            # Window image based on the 0.5 and 99.5 percentiles of the entire
-            # image.
-            lower = np.percentile(
-                image,
-                preprocessing_constants.PreprocessingConstants.WINDOW_PERCENTILE_LOW
-            )
-            upper = np.percentile(
-                image,
-                preprocessing_constants.PreprocessingConstants.WINDOW_PERCENTILE_HIGH
-            )
+        # values of either the entire image or the nonzero values. We compute
+        # both percentiles with a single call so that the values are only
+        # sorted once.
+        values = nonzeros if config["use_nz_mask"] else image
+        lower, upper = np.percentile(
+            values,
+            [
+                preprocessing_constants.PreprocessingConstants.WINDOW_PERCENTILE_LOW,
+                preprocessing_constants.PreprocessingConstants.WINDOW_PERCENTILE_HIGH,
+            ]
+        )
 
-            # Get mean and standard deviation of the entire image.
-            mean = np.mean(image)
-            std = np.std(image)
+        # Compute the mean and standard deviation of the nonzero values or the
+        # entire image.
+        mean = np.mean(values)
+        std = np.std(values)
 
     # Window the image based on the lower and upper values.
-    image = np.clip(image, lower, upper)
+    np.clip(image, lower, upper, out=image)
 
     # Normalize the image based on the mean and standard deviation.
-    image = (image - mean) / std
+    image -= mean
+    image /= std
 
     # Apply nonzero mask if necessary.
     if config["use_nz_mask"]:
         image *= nonzero_mask
 
-    return image.astype(np.float32)
+    return image
 
 
 def compute_dtm(
@@ -316,22 +418,26 @@ def compute_dtm(
 
 def preprocess_example(
     config: Dict[str, Any],
-    image_paths_list: List[str],
+    image_paths_list: List[Union[str, ants.core.ants_image.ANTsImage]],
     mask_path: Optional[str]=None,
     fg_bbox: Optional[Dict[str, int]]=None,
     use_dtm: bool=False,
     normalize_dtm: bool=False,
+    gpu_resample: bool=False,
 ) -> Dict[str, Union[npt.NDArray[Any], Dict[str, int], None]]:
     """Preprocessing function for a single example.
 
     Args:
         config: Dictionary with information from config.json.
         image_paths_list: List containing paths to images for the example.
+            Images that are already loaded can be given as ANTs images to
+            avoid reading them again.
         mask_path: Path to segmentation mask.
         use_dtm: Set to true to compute and output DTMs.
         normalize_dtm: Set to true to normalize DTM to have
             values between -1 and 1.
         fg_bbox: Information about the bounding box for the foreground.
+        gpu_resample: Set to true to resample images on the GPU.
     Returns:
         preprocessed_output: Dictionary containing the following keys:
             image: Preprocessed image(s) as a numpy array.
@@ -345,10 +451,10 @@ def preprocess_example(
         training = False
 
     # Read all images (and mask if training).
-    images = []
-    for i, image_path in enumerate(image_paths_list):
-        # Load image as ants image.
-        image = ants.image_read(image_path)
+    for i, image in enumerate(image_paths_list):
+        # Load image as ants image if it is not already loaded.
+        if isinstance(image, str):
+            image = ants.image_read(image)
 
         # Get foreground mask if necessary.
         if i == 0 and config["crop_to_fg"] and fg_bbox is None:
@@ -365,7 +471,13 @@ def preprocess_example(
 
         # N4 bias correction.
         if config["use_n4_bias_correction"]:
-            image = ants.n4_bias_field_correction(image)
+            image = n4_bias_field_correction(
+                image,
+                shrink_factor=config.get(
+                    "n4_shrink_factor",
+                    preprocessing_constants.PreprocessingConstants.N4_SHRINK_FACTOR
+                ),
+            )
 
         # Put all images into standard space.
         image = ants.reorient_image2(image, "RAI")
@@ -373,11 +485,28 @@ def preprocess_example(
             preprocessing_constants.PreprocessingConstants.RAI_ANTS_DIRECTION
         )
         if not np.array_equal(image.spacing, config["target_spacing"]):
-            image = resample_image(
-                image, target_spacing=config["target_spacing"]
-            )
+            if gpu_resample:
+                image = resample_image_gpu(
+                    image, target_spacing=config["target_spacing"]
+                )
+            else:
+                image = resample_image(
+                    image, target_spacing=config["target_spacing"]
+                )
 
-        images.append(image)
+        # Apply windowing and normalization to the image and write it directly
+        # into the output array. All images have the same dimensions in
+        # standard space, so we allocate the output once we know the dimensions
+        # of the first image.
+        if i == 0:
+            preprocessed_numpy_image = np.empty(
+                (*image.shape, len(image_paths_list)), dtype=np.float32
+            )
+        np.copyto(
+            preprocessed_numpy_image[..., i],
+            window_and_normalize(image.numpy(), config),
+            casting="unsafe",
+        )
 
     if training:
         # Read mask if we are in training mode
@@ -412,20 +541,13 @@ def preprocess_example(
         else:
             dtm = None
 
-        # Add channel axis to mask
-        mask = np.expand_dims(mask.numpy(), axis=-1)
+        # Add channel axis to mask. Masks are saved as uint8, so we cast them
+        # here to avoid carrying a float32 copy around.
+        mask = np.expand_dims(mask.numpy().astype(np.uint8), axis=-1)
     else:
         mask = None
         dtm = None
 
-    # Apply windowing and normalization to images
-    # Get dimensions of image in standard space
-    preprocessed_numpy_image = np.zeros((*images[0].shape, len(images)))
-    for i, image in enumerate(images):
-        preprocessed_numpy_image[..., i] = window_and_normalize(
-            image.numpy(), config
-        )
-
     preprocessed_output = {
         "image": preprocessed_numpy_image,
         "mask": mask,
@@ -437,33 +559,37 @@ def preprocess_example(
 
 
 def convert_nifti_to_numpy(
-        image_list: List[str],
-        mask: Optional[str]=None,
+        image_list: List[Union[str, ants.core.ants_image.ANTsImage]],
+        mask: Optional[Union[str, ants.core.ants_image.ANTsImage]]=None,
     ) -> Dict[str, Union[npt.NDArray[Any], None]]:
     """Convert NIfTI images to numpy arrays.
 
     Args:
-        image_list: List of paths to NIfTI images.
-        mask: Path to segmentation mask.
+        image_list: List of paths to NIfTI images or already loaded ANTs
+            images.
+        mask: Path to segmentation mask or already loaded ANTs image.
     
     Returns:
         conversion_output: Dictionary with the following keys:
             image: Numpy array of images.
             mask: Numpy array of mask.
     """
-    dims = ants.image_header_info(image_list[0])
-    dims = dims["dimensions"]
-
-    # Convert images
-    image_npy = np.zeros((*dims, len(image_list)))
-    for i, image_path in enumerate(image_list):
-        image = ants.image_read(image_path)
+    # Convert images. We read each image once and get the dimensions of the
+    # output from the first image.
+    for i, image in enumerate(image_list):
+        if isinstance(image, str):
+            image = ants.image_read(image)
+        if i == 0:
+            image_npy = np.empty(
+                (*image.shape, len(image_list)), dtype=np.float32
+            )
         image_npy[..., i] = image.numpy()
 
     # Convert mask if given
     if mask is not None:
-        mask_npy = ants.image_read(mask)
-        mask_npy = np.expand_dims(mask_npy.numpy(), axis=-1)
+        if isinstance(mask, str):
+            mask = ants.image_read(mask)
+        mask_npy = np.expand_dims(mask.numpy().astype(np.uint8), axis=-1)
     else:
         mask_npy = None
 
@@ -477,6 +603,74 @@ def convert_nifti_to_numpy(
     return conversion_output
 
 
+def _init_preprocess_worker(num_threads: int) -> None:
+    """Limit the number of ITK threads used by a preprocessing worker.
+
+    Args:
+        num_threads: Number of threads each SimpleITK filter may use.
+    """
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(num_threads)
+
+
+def _preprocess_and_save_patient(
+        patient: Dict[str, Any],
+        fg_bbox: Optional[Dict[str, int]],
+        config: Dict[str, Any],
+        output_directories: Dict[str, str],
+        no_preprocess: bool,
+        use_dtms: bool,
+        normalize_dtms: bool,
+        gpu_resample: bool,
+) -> None:
+    """Preprocess a single patient and save the outputs as numpy files.
+
+    Args:
+        patient: Row of the training paths dataframe for the patient.
+        fg_bbox: Foreground bounding box for the patient or None.
+        config: Dictionary with information from config.json.
+        output_directories: Directories to save the images, labels, and DTMs.
+        no_preprocess: Set to true to only convert the NIfTI files to numpy.
+        use_dtms: Set to true to compute and save DTMs.
+        normalize_dtms: Set to true to normalize DTMs to have values between
+            -1 and 1.
+        gpu_resample: Set to true to resample images on the GPU.
+    """
+    # Get list of image paths and segmentation mask
+    image_list = list(patient.values())[3:len(patient)]
+    mask = patient["mask"]
+
+    # If the user turns off preprocessing, simply convert NIfTI images to numpy
+    # arrays.
+    if no_preprocess:
+        current_preprocessed_example = convert_nifti_to_numpy(image_list, mask)
+    else:
+        current_preprocessed_example = preprocess_example(
+            config=config,
+            image_paths_list=image_list,
+            mask_path=mask,
+            fg_bbox=fg_bbox,
+            use_dtm=use_dtms,
+            normalize_dtm=normalize_dtms,
+            gpu_resample=gpu_resample,
+        )
+
+    # Save images and masks as numpy arrays.
+    np.save(
+        os.path.join(output_directories["images"], f"{patient['id']}.npy"),
+        current_preprocessed_example["image"].astype("float32", copy=False) # type: ignore
+    )
+    np.save(
+        os.path.join(output_directories["labels"], f"{patient['id']}.npy"),
+        current_preprocessed_example["mask"].astype("uint8", copy=False) # type: ignore
+    )
+
+    if use_dtms:
+        np.save(
+            os.path.join(output_directories["dtms"], f"{patient['id']}.npy"),
+            current_preprocessed_example["dtm"].astype("float32", copy=False) # type: ignore
+        )
+
+
 def preprocess_dataset(args: argparse.Namespace) -> None:
     """Preprocess a MIST compatible dataset.
 
@@ -537,71 +731,76 @@ def preprocess_dataset(args: argparse.Namespace) -> None:
         )
     fg_bboxes = pd.read_csv(os.path.join(args.results, "fg_bboxes.csv"))
 
-    with progress as pb:
-        for i in pb.track(range(len(df))):
+    # Index the foreground bounding boxes by patient ID once instead of
+    # searching the dataframe for every patient. We remove the ID key from each
+    # bounding box since we do not need it for preprocessing.
+    fg_bboxes_by_id = {
+        fg_bbox.pop("id"): fg_bbox
+        for fg_bbox in fg_bboxes.to_dict("records")
+    }
+
+    # Patients are independent of each other, so we preprocess them in
+    # parallel with a pool of worker processes. Each worker reads, preprocesses,
+    # and saves a single patient. The CPUs are split between the workers so
+    # that the multithreaded SimpleITK filters do not oversubscribe them.
+    num_cpus = os.cpu_count() or 1
+    max_workers = args.num_preprocess_workers or min(
+        num_cpus,
+        preprocessing_constants.PreprocessingConstants.MAX_DEFAULT_PREPROCESS_WORKERS
+    )
+
+    # Each worker that resamples on the GPU creates its own CUDA context, so
+    # we cap the number of workers to avoid running out of GPU memory.
+    if args.gpu_resample:
+        max_workers = min(
+            max_workers,
+            preprocessing_constants.PreprocessingConstants.MAX_GPU_RESAMPLE_WORKERS
+        )
+
+    # Start the workers with spawn instead of fork. Forking is unsafe while the
+    # progress bar's refresh thread is running and does not work with CUDA.
+    with progress as pb, concurrent.futures.ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_preprocess_worker,
+        initargs=(max(1, num_cpus // max_workers),),
+    ) as executor:
+        task = pb.add_task("", total=len(df))
+        futures = {}
+        for i in range(len(df)):
             # Get paths to images for single patient
             patient = df.iloc[i].to_dict()
 
-            # Get list of image paths and segmentation mask
-            image_list = list(patient.values())[3:len(patient)]
-            mask = patient["mask"]
-
-            # If the user turns off preprocessing, simply convert NIfTI
-            # images to numpy arrays.
-            if args.no_preprocess:
-                current_preprocessed_example = convert_nifti_to_numpy(
-                    image_list,
-                    mask
-                )
+            # Get foreground bounding box if necessary. These are already
+            # computed and saved in a separate CSV file during the analysis
+            # portion of the MIST pipeline.
+            if config["crop_to_fg"] and not args.no_preprocess:
+                fg_bbox = fg_bboxes_by_id[patient["id"]]
             else:
-                # Get foreground bounding box if necessary. These are already
-                # computed and saved in a separate CSV file during the analysis
-                # portion of the MIST pipeline.
-                if config["crop_to_fg"]:
-                    fg_bbox = fg_bboxes.loc[
-                        fg_bboxes["id"] == patient["id"]
-                    ].iloc[0].to_dict()
-
-                    # Remove the ID key from the dictionary. We do not need it
-                    # for preprocessing.
-                    fg_bbox.pop("id")
-                else:
-                    fg_bbox = None
-
-                # Preprocess the example.
-                current_preprocessed_example = preprocess_example(
-                    config=config,
-                    image_paths_list=image_list,
-                    mask_path=mask,
-                    fg_bbox=fg_bbox,
-                    use_dtm=args.use_dtms,
-                    normalize_dtm=args.normalize_dtms,
-                )
-
-            # Save images and masks as numpy arrays.
-            np.save(
-                os.path.join(
-                    args.numpy,
-                    output_directories["images"],
-                    f"{patient['id']}.npy"
-                ),
-                current_preprocessed_example["image"].astype("float32") # type: ignore
+                fg_bbox = None
+
+            future = executor.submit(
+                _preprocess_and_save_patient,
+                patient=patient,
+                fg_bbox=fg_bbox,
+                config=config,
+                output_directories=output_directories,
+                no_preprocess=args.no_preprocess,
+                use_dtms=args.use_dtms,
+                normalize_dtms=args.normalize_dtms,
+                gpu_resample=args.gpu_resample,
             )
-            np.save(
-                os.path.join(
-                    args.numpy,
-                    output_directories["labels"],
-                    f"{patient['id']}.npy"
-                ),
-                current_preprocessed_example["mask"].astype("uint8") # type: ignore
-            )
-
-            if args.use_dtms:
-                np.save(
-                    os.path.join(
-                        args.numpy,
-                        output_directories["dtms"],
-                        f"{patient['id']}.npy"
-                    ),
-                    current_preprocessed_example["dtm"].astype("float32") # type: ignore
-                )
+            futures[future] = patient["id"]
+
+        # Update the progress bar as patients finish.
+        for future in concurrent.futures.as_completed(futures):
+            try:
+                future.result()
+            except Exception as e:
+                # Cancel the patients that have not started yet so that the
+                # error surfaces right away, then raise it with the patient ID.
+                executor.shutdown(wait=False, cancel_futures=True)
+                raise RuntimeError(
+                    f"Preprocessing failed for patient {futures[future]}."
+                ) from e
+            pb.advance(task)
@@ -10,5 +10,18 @@ class PreprocessingConstants:
     WINDOW_PERCENTILE_LOW = 0.5
     WINDOW_PERCENTILE_HIGH = 99.5
 
+    # N4 bias field correction constants. The shrink factor is used if the
+    # configuration file does not specify one.
+    N4_SHRINK_FACTOR = 4
+
+    # Default maximum number of worker processes for preprocessing. Each worker
+    # holds full volumes and one-hot encoded masks in memory, so we do not use
+    # every core by default.
+    MAX_DEFAULT_PREPROCESS_WORKERS = 4
+
+    # Maximum number of worker processes for preprocessing when resampling on
+    # the GPU. Each worker opens its own CUDA context on the GPU.
+    MAX_GPU_RESAMPLE_WORKERS = 2
+
     # RAI orientation constants.
     RAI_ANTS_DIRECTION = np.eye(3)
@@ -61,6 +61,11 @@ def get_main_args():
     p.arg("--seed_val", type=non_negative_int, default=42, help="Random seed")
     p.boolean_flag("--tta", default=False, help="Enable test time augmentation")
     p.boolean_flag("--overwrite", default=False, help="Overwrites previous run at specified results folder")
+    p.boolean_flag("--deterministic", default=False, help="Disable cuDNN benchmarking for reproducible training")
+    p.arg("--debug-dump-patches",
+          type=non_negative_int,
+          default=0,
+          help="Number of training patches to write to disk for debugging, 0 turns this off")
 
 
     # Output
@@ -69,6 +74,18 @@ def get_main_args():
 
     # AMP
     p.boolean_flag("--amp", default=False, help="Enable automatic mixed precision (recommended)")
+    p.arg("--amp-dtype",
+          type=str,
+          default="auto",
+          choices=["auto", "fp16", "bf16"],
+          help="Data type for automatic mixed precision, auto uses bf16 if the GPU supports it")
+
+    # Compilation and memory format
+    p.boolean_flag("--compile", default=False, help="Compile the model with torch.compile during training and inference")
+    p.boolean_flag("--channels-last", default=False, help="Use the channels last memory format for the model and inputs")
+    p.boolean_flag("--ddp-comm-fp16",
+                   default=False,
+                   help="Compress gradients to 16 bits before the allreduce in multi-gpu training")
 
     # Training hyperparameters
     p.arg("--batch-size", type=positive_int, help="Batch size")
@@ -119,9 +136,17 @@ def get_main_args():
     # Preprocessing
     p.boolean_flag("--no-preprocess", default=False, help="Turn off preprocessing")
     p.boolean_flag("--use-n4-bias-correction", default=False, help="Use N4 bias field correction (only for MR images)")
+    p.arg("--n4-shrink-factor",
+          type=positive_int,
+          default=4,
+          help="Factor to downsample images by when estimating the N4 bias field")
     p.boolean_flag("--use-config-class-weights", default=False, help="Use class weights in config file")
     p.boolean_flag("--use-dtms", default=False, help="Compute and use DTMs during training")
     p.boolean_flag("--normalize-dtms", default=False, help="Normalize DTMs to have values between -1 and 1")
+    p.boolean_flag("--gpu-resample", default=False, help="Resample images with trilinear interpolation on the GPU, uses at most 2 preprocessing processes")
+    p.arg("--num-preprocess-workers",
+          type=positive_int,
+          help="Number of processes to use for preprocessing, defaults to the number of CPUs up to 4")
 
     p.arg("--class-weights", nargs="+", type=float, help="Specify class weights")
 
@@ -157,6 +182,10 @@ def get_main_args():
           type=float_0_1,
           default=0.25,
           help="Amount of overlap between patches during sliding window inference during validation")
+    p.arg("--val-sw-batch-size",
+          type=positive_int,
+          default=4,
+          help="Number of windows per forward pass during sliding window inference during validation")
     p.arg("--blend-mode",
           type=str,
           choices=["gaussian", "constant"],
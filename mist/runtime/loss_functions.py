@@ -1,3 +1,6 @@
+import dataclasses
+from typing import Dict, List, Optional
+
 import torch
 import torch.nn as nn
 from torch.nn.functional import softmax
@@ -268,3 +271,126 @@ def get_loss(args, **kwargs):
         return SoftDiceCLDice()
     else:
         raise ValueError("Invalid loss function")
+
+
+@dataclasses.dataclass(frozen=True)
+class LossConfig:
+    """Configuration for composing the training loss.
+
+    This is built once per fold so that the training step receives the loss
+    configuration as plain values instead of looking up user arguments.
+
+    Attributes:
+        use_dtms: Pass distance transform maps to the loss function.
+        loss_name: Name of the loss function.
+        deep_sup: Add losses from the deep supervision heads.
+        vae_reg: Add the VAE regularization loss.
+        l2_reg: Add L2 regularization of the model parameters.
+        l1_reg: Add L1 regularization of the model parameters.
+        vae_penalty: Weight for the VAE regularization loss.
+        l2_penalty: Weight for the L2 regularization term.
+        l1_penalty: Weight for the L1 regularization term.
+        ds_weights: Weights for each deep supervision head as a tensor.
+        c_norm: Normalization constant for each number of deep supervision
+            heads.
+    """
+    use_dtms: bool
+    loss_name: str
+    deep_sup: bool
+    vae_reg: bool
+    l2_reg: bool
+    l1_reg: bool
+    vae_penalty: float
+    l2_penalty: float
+    l1_penalty: float
+    ds_weights: torch.Tensor
+    c_norm: Dict[int, float]
+
+
+def compose_loss(
+        model: nn.Module,
+        image: torch.Tensor,
+        label: torch.Tensor,
+        dtm: Optional[torch.Tensor],
+        alpha: Optional[torch.Tensor],
+        loss_fn: nn.Module,
+        config: LossConfig,
+        vae_loss_fn: Optional[nn.Module]=None,
+        params: Optional[List[torch.Tensor]]=None,
+) -> torch.Tensor:
+    """Make predictions for a batch and compute the total training loss.
+
+    Args:
+        model: Model to train.
+        image: Input image.
+        label: Ground truth label.
+        dtm: Distance transform map.
+        alpha: Weighting factor for boundary-based and cldice loss functions.
+        loss_fn: Loss function for the predictions.
+        config: Loss configuration.
+        vae_loss_fn: Loss function for VAE regularization.
+        params: Model parameters used for L1 and L2 regularization.
+
+    Returns:
+        loss: Loss value for the batch.
+    """
+    # Make predictions for the batch.
+    output = model(image)
+
+    # The inputs to the loss function depend on the loss function being used.
+    # We use distance transform maps and the alpha parameter for boundary-based
+    # loss functions, the alpha parameter to weight the cldice and dice with
+    # cross entropy loss functions, and only the label and prediction for other
+    # loss functions like dice with cross entropy.
+    if config.use_dtms:
+        loss_args = (dtm, alpha)
+    elif config.loss_name in ["cldice"]:
+        loss_args = (alpha,)
+    else:
+        loss_args = ()
+    loss = loss_fn(label, output["prediction"], *loss_args)
+
+    # If deep supervision is enabled, compute the additional losses from the
+    # deep supervision heads. We scale the loss from each head by a factor of
+    # (0.5 ** (k + 1)), where k is the index of the head. This creates a
+    # geometric series that gives decreasing weight to deeper (later) heads.
+    # We then normalize the total loss using a correction factor derived from
+    # the sum of the geometric series (1 / (2 - 2 ** -(n + 1))), where n is the
+    # number of heads, so that the total loss isn't dominated by the deep
+    # supervision losses.
+    if config.deep_sup:
+        heads = output["deep_supervision"]
+        head_losses = torch.stack(
+            [loss_fn(label, p, *loss_args) for p in heads]
+        )
+        loss += torch.sum(config.ds_weights[:len(heads)] * head_losses)
+        loss *= config.c_norm[len(heads)]
+
+    # Collect the scalar loss components and sum them once at the end.
+    loss_components = [loss]
+
+    # VAE regularization encourages the model to learn a latent space that
+    # follows a normal distribution. The VAE loss is the sum of the
+    # Kullback-Leibler divergence and the reconstruction loss, scaled by
+    # vae_penalty.
+    if config.vae_reg:
+        vae_loss = vae_loss_fn(image, output["vae_reg"])
+        loss_components.append(config.vae_penalty * vae_loss)
+
+    # L2 and L1 regularization terms based on the norms of the model's
+    # parameters. The norms of all parameters are computed with a single
+    # multi-tensor foreach call instead of one reduction kernel per parameter.
+    if config.l2_reg:
+        l2_norm_of_model_parameters = torch.stack(
+            torch._foreach_norm(params, 2.0)
+        ).sum()
+        loss_components.append(config.l2_penalty * l2_norm_of_model_parameters)
+
+    if config.l1_reg:
+        l1_norm_of_model_parameters = torch.stack(
+            torch._foreach_norm(params, 1.0)
+        ).sum()
+        loss_components.append(config.l1_penalty * l1_norm_of_model_parameters)
+
+    # Sum all of the loss components.
+    return torch.stack(loss_components).sum()
@@ -1,15 +1,20 @@
 """Training class for MIST."""
+import collections
+import concurrent.futures
+import contextlib
+import math
 import os
-from typing import Optional
+from typing import Deque, Optional, Tuple, Union
 
+import ants
 import numpy as np
 import pandas as pd
 import rich
 import torch
 import torch.distributed as dist
 import torch.multiprocessing as mp
-from sklearn.model_selection import train_test_split
 from torch import nn
+from torch.distributed.algorithms.ddp_comm_hooks import default_hooks
 from torch.nn.parallel import DistributedDataParallel as DDP
 from torch.utils.tensorboard import SummaryWriter
 from monai.inferers import sliding_window_inference
@@ -130,6 +135,18 @@ class Trainer:
             self.file_paths["training_paths_dataframe"]
         )
 
+        # Get the training ids for each fold once. The training ids for a fold
+        # are the ids of all patients that are not in that fold.
+        training_paths_dataframe = (
+            self.data_structures["training_paths_dataframe"]
+        )
+        self.data_structures["training_ids_by_fold"] = {
+            fold: training_paths_dataframe.loc[
+                training_paths_dataframe["fold"] != fold, "id"
+            ].to_numpy()
+            for fold in training_paths_dataframe["fold"].unique()
+        }
+
     def _create_model_configuration(self):
         """Create model configuration.
 
@@ -225,11 +242,67 @@ class Trainer:
         os.environ["MASTER_PORT"] = self.mist_arguments.master_port
         dist.init_process_group("nccl", rank=rank, world_size=world_size)
 
+        # Allow TF32 tensor cores for float32 matrix multiplications and
+        # convolutions on Ampere or newer GPUs.
+        torch.backends.cuda.matmul.allow_tf32 = True
+        torch.backends.cudnn.allow_tf32 = True
+
+        # Let cuDNN benchmark and cache the fastest convolution algorithms for
+        # each input shape. Patch sizes are fixed during training, so this
+        # search only runs once. Benchmarking can select different algorithms
+        # between runs, so we turn it off if the user asks for deterministic
+        # training.
+        if self.mist_arguments.deterministic:
+            torch.backends.cudnn.benchmark = False
+            torch.backends.cudnn.deterministic = True
+        else:
+            torch.backends.cudnn.benchmark = True
+
     # Clean up processes after distributed training
     def cleanup(self):
         """Clean up processes after distributed training."""
         dist.destroy_process_group()
 
+    @staticmethod
+    def _write_debug_patch(
+            image: torch.Tensor,
+            label: torch.Tensor,
+            copy_done: torch.cuda.Event,
+            output_dir: str,
+            patch_id: int,
+    ) -> None:
+        """Write a training patch to disk for debugging.
+
+        Each image channel and the label are written as separate NIfTI files.
+
+        Args:
+            image: Image patch in pinned host memory with shape (channels,
+                depth, height, width).
+            label: Label patch in pinned host memory with shape (1, depth,
+                height, width).
+            copy_done: Event recorded after the non-blocking copies of the
+                image and label patches to the host.
+            output_dir: Directory to write the patches to.
+            patch_id: Index of the patch, used in the file names.
+        """
+        # Wait for the copies from the GPU to finish before reading the
+        # patches. This only blocks the writer thread.
+        copy_done.synchronize()
+        image = image.numpy()
+        label = label.numpy()
+
+        for channel in range(image.shape[0]):
+            ants.image_write(
+                ants.from_numpy(image[channel]),
+                os.path.join(
+                    output_dir, f"image{patch_id:02}_{channel:02}.nii.gz"
+                ),
+            )
+        ants.image_write(
+            ants.from_numpy(label[0]),
+            os.path.join(output_dir, f"label{patch_id:02}.nii.gz"),
+        )
+
     def train(self, rank: int, world_size: int) -> None:
         """Train the model.
 
@@ -249,14 +322,23 @@ class Trainer:
             text.stylize("bold")
             console.print(text)
 
+            # Display the data type used for automatic mixed precision. With
+            # "auto", this depends on the GPU, so we show the resolved type.
+            if self.mist_arguments.amp:
+                console.print(
+                    "Using automatic mixed precision with "
+                    f"{utils.get_amp_dtype(self.mist_arguments.amp_dtype)}\n"
+                )
+
         # Start training for each fold.
         for fold in self.mist_arguments.folds:
-            # Get training ids from dataframe.
-            train_ids = list(
-                self.data_structures["training_paths_dataframe"].loc[
-                    self.data_structures["training_paths_dataframe"]["fold"]
-                    != fold
-                ]["id"]
+            # Get training ids for this fold.
+            # If no patients are in this fold, we train on all patients.
+            train_ids = self.data_structures["training_ids_by_fold"].get(
+                fold,
+                self.data_structures["training_paths_dataframe"][
+                    "id"
+                ].to_numpy(),
             )
 
             # Get list of training images and labels.
@@ -270,35 +352,37 @@ class Trainer:
                 folder="labels",
                 patient_ids=train_ids,
             )
+
+            # Split the data into training and validation sets. We shuffle the
+            # indices of the training data once with a seeded random number
+            # generator and hold out the first val_percent of them for
+            # validation.
+            rng = np.random.default_rng(self.mist_arguments.seed_val)
+            indices = rng.permutation(len(train_images))
+            n_val = int(
+                np.ceil(len(train_images) * self.mist_arguments.val_percent)
+            )
+            val_indices, train_indices = indices[:n_val], indices[n_val:]
+
+            train_images = np.array(train_images, dtype=object)
+            train_labels = np.array(train_labels, dtype=object)
+            val_images = train_images[val_indices].tolist()
+            val_labels = train_labels[val_indices].tolist()
+            train_images = train_images[train_indices].tolist()
+            train_labels = train_labels[train_indices].tolist()
+
             if self.mist_arguments.use_dtms:
-                # Get list of training distance transform maps.
+                # Get list of training distance transform maps. We only need
+                # the distance transform maps for the training set.
                 train_dtms = utils.get_numpy_file_paths_list(
                     base_dir=self.mist_arguments.numpy,
                     folder="dtms",
                     patient_ids=train_ids,
                 )
-
-                # Split into training and validation sets with distance
-                # transform maps.
-                train_images, val_images, train_labels_dtms, val_labels_dtms = train_test_split(
-                    train_images,
-                    list(zip(train_labels, train_dtms)),
-                    test_size=self.mist_arguments.val_percent,
-                    random_state=self.mist_arguments.seed_val,
-                )
-
-                # Unpack labels and distance transform maps.
-                train_labels, train_dtms = zip(*train_labels_dtms)
-                val_labels, _ = zip(*val_labels_dtms)
+                train_dtms = np.array(train_dtms, dtype=object)[
+                    train_indices
+                ].tolist()
             else:
-                # Split data into training and validation sets without DTMs
-                train_images, val_images, train_labels, val_labels = train_test_split(
-                    train_images,
-                    train_labels,
-                    test_size=self.mist_arguments.val_percent,
-                    random_state=self.mist_arguments.seed_val
-                )
-
                 # No DTMs in this case.
                 train_dtms = None
 
@@ -399,13 +483,121 @@ class Trainer:
 
             # Set up model for distributed data parallel training.
             model.to(rank)
+
+            # Convert the model to the channels last memory format if enabled.
+            # The channels last (NDHWC) layout lets cuDNN use faster tensor core
+            # kernels for 3D convolutions. Unsupported operations only fail
+            # during the forward pass, so we check the conversion with a forward
+            # pass on a single patch. If it fails, we fall back to the default
+            # (NCDHW) format.
+            channels_last = self.mist_arguments.channels_last
+            if channels_last:
+                model = model.to(memory_format=torch.channels_last_3d)
+                try:
+                    model.eval()
+                    with torch.no_grad():
+                        model(
+                            torch.zeros(
+                                (
+                                    1,
+                                    self.data_structures["model_configuration"][
+                                        "n_channels"
+                                    ],
+                                    *self.data_structures["mist_configuration"][
+                                        "patch_size"
+                                    ],
+                                ),
+                                device=rank,
+                            ).contiguous(memory_format=torch.channels_last_3d)
+                        )
+                except RuntimeError:
+                    channels_last = False
+                    model = model.to(memory_format=torch.contiguous_format)
+                    if rank == 0:
+                        console.print(
+                            "Model does not support the channels last memory "
+                            "format. Using the default memory format instead."
+                        )
+            input_memory_format = (
+                torch.channels_last_3d if channels_last
+                else torch.preserve_format
+            )
+            # The model architecture does not change during training, so we
+            # use DDP's static graph mode. This lets DDP reorder gradient
+            # buckets and start the allreduce early to overlap communication
+            # with the backward pass. We also use larger buckets for the large
+            # convolution parameters in 3D models and let the gradients alias
+            # the bucket storage to avoid an extra copy.
             if self.mist_arguments.model != "pretrained":
-                model = DDP(model, device_ids=[rank])
+                model = DDP(
+                    model,
+                    device_ids=[rank],
+                    bucket_cap_mb=50,
+                    static_graph=True,
+                    gradient_as_bucket_view=True,
+                )
             else:
                 # This seems to work with pretrained models. We will need to
-                # test this further.
+                # test this further. Static graph mode is not compatible with
+                # finding unused parameters.
                 model = DDP(
-                    model, device_ids=[rank], find_unused_parameters=True
+                    model,
+                    device_ids=[rank],
+                    find_unused_parameters=True,
+                    bucket_cap_mb=50,
+                    static_graph=False,
+                    gradient_as_bucket_view=True,
+                )
+
+            # Compress gradients to 16 bits before the allreduce if enabled.
+            # This halves the amount of data sent between GPUs each step. We
+            # only use bfloat16 if AMP is enabled with bfloat16. Otherwise, we
+            # use float16, which keeps more mantissa bits.
+            if self.mist_arguments.ddp_comm_fp16:
+                use_bf16_compression = (
+                    self.mist_arguments.amp and
+                    utils.get_amp_dtype(self.mist_arguments.amp_dtype) ==
+                    torch.bfloat16
+                )
+                model.register_comm_hook(
+                    state=None,
+                    hook=(
+                        default_hooks.bf16_compress_hook
+                        if use_bf16_compression
+                        else default_hooks.fp16_compress_hook
+                    ),
+                )
+
+            # Cache the list of trainable parameters once per fold so that the
+            # training step does not walk the module tree on every iteration.
+            # These are used for L1/L2 regularization and gradient clipping.
+            trainable_params = [
+                param for param in model.parameters() if param.requires_grad
+            ]
+
+            # Compile the model with torch.compile if enabled. This fuses
+            # convolutions, normalizations, and activations into fewer kernels
+            # and, with "reduce-overhead", captures CUDA graphs to amortize
+            # Python overhead over the fixed patch size. CUDA graphs require a
+            # static graph, so pretrained models that need
+            # find_unused_parameters fall back to the default mode. We raise
+            # the recompilation cache limit a little so that the training,
+            # evaluation, and deep supervision variants of the model fit in
+            # the cache. If a graph fails to compile or the cache limit is hit,
+            # we fall back to running it eagerly instead of stopping training
+            # and print a warning on the first process (i.e., rank 0).
+            if self.mist_arguments.compile:
+                torch._dynamo.config.cache_size_limit = 64
+                utils.enable_compile_eager_fallback(warn=rank == 0)
+                model = torch.compile(
+                    model,
+                    mode=(
+                        "reduce-overhead"
+                        if self.mist_arguments.model != "pretrained"
+                        else "default"
+                    ),
+                    fullgraph=False,
+                    backend="inductor",
                 )
 
             # Get optimizer and lr scheduler
@@ -421,7 +613,14 @@ class Trainer:
             # before the backward pass, increasing gradient magnitudes to avoid
             # underflow. Gradients must be unscaled before the optimizer updates
             # the parameters to ensure the learning rate is unaffected.
-            if self.mist_arguments.amp:
+            #
+            # Bfloat16 has the same exponent range as float32, so gradients do
+            # not underflow and no gradient scaling is needed. We use bfloat16
+            # when requested or, with "auto", when the GPU supports it (i.e.,
+            # Ampere or newer).
+            amp_dtype = utils.get_amp_dtype(self.mist_arguments.amp_dtype)
+            amp_gradient_scaler = None
+            if self.mist_arguments.amp and amp_dtype == torch.float16:
                 amp_gradient_scaler = torch.amp.GradScaler("cuda")
 
             # Only log metrics on first process (i.e., rank 0).
@@ -431,7 +630,7 @@ class Trainer:
                 running_loss_validation = utils.RunningMean()
 
                 # Initialize best validation loss to infinity.
-                best_validation_loss = np.Inf
+                best_validation_loss = math.inf
 
                 # Set up tensorboard summary writer.
                 writer = SummaryWriter(
@@ -444,12 +643,48 @@ class Trainer:
                 best_model_name = os.path.join(
                     self.mist_arguments.results, "models", f"fold_{fold}.pt"
                 )
+            else:
+                # Other processes do not keep track of the running losses.
+                running_loss_train = None
+                running_loss_validation = None
+
+            # Build the loss configuration once per fold so that the training
+            # step does not repeat attribute lookups every iteration. We
+            # precompute the deep supervision weights (0.5 ** (k + 1)) for each
+            # head and the normalization constant (1 / (2 - 2 ** -(n + 1))) for
+            # each possible number of heads. See loss_functions.compose_loss
+            # for details.
+            max_heads = (
+                self.data_structures["model_configuration"][
+                    "deep_supervision_heads"
+                ]
+            )
+            loss_config = loss_functions.LossConfig(
+                use_dtms=self.mist_arguments.use_dtms,
+                loss_name=self.mist_arguments.loss,
+                deep_sup=self.mist_arguments.deep_supervision,
+                vae_reg=self.mist_arguments.vae_reg,
+                l2_reg=self.mist_arguments.l2_reg,
+                l1_reg=self.mist_arguments.l1_reg,
+                vae_penalty=self.mist_arguments.vae_penalty,
+                l2_penalty=self.mist_arguments.l2_penalty,
+                l1_penalty=self.mist_arguments.l1_penalty,
+                ds_weights=torch.tensor(
+                    [0.5 ** (k + 1) for k in range(max_heads)],
+                    dtype=torch.float32,
+                    device=rank,
+                ),
+                c_norm={
+                    n: 1.0 / (2 - 2 ** -(n + 1))
+                    for n in range(1, max_heads + 1)
+                },
+            )
 
             def train_step(
                     image: torch.Tensor,
                     label: torch.Tensor,
                     dtm: Optional[torch.Tensor],
-                    alpha: Optional[float],
+                    alpha: Optional[torch.Tensor],
             ) -> torch.Tensor:
                 """Perform a single training step.
 
@@ -462,6 +697,18 @@ class Trainer:
                 Returns:
                     loss: Loss value for the batch.
                 """
+                # Make sure that the inputs are on the current device in the
+                # memory format of the model. DALI already returns tensors on
+                # the GPU, so this only copies the image if the memory format
+                # changes. Any copies are non-blocking and do not synchronize
+                # the host with the GPU.
+                image = image.to(
+                    rank, non_blocking=True, memory_format=input_memory_format
+                )
+                label = label.to(rank, non_blocking=True)
+                if dtm is not None:
+                    dtm = dtm.to(rank, non_blocking=True)
+
                 # Compute loss for the batch.
                 def compute_loss() -> torch.Tensor:
                     """Compute loss for the batch.
@@ -472,153 +719,50 @@ class Trainer:
                     Returns:
                         loss: Loss value for the batch.
                     """
-                    # Make predictions for the batch.
-                    output = model(image)
-
-                    # Compute loss for the batch. The inputs to the loss
-                    # function depend on the loss function being used.
-                    if self.mist_arguments.use_dtms:
-                        # Use distance transform maps for boundary-based loss
-                        # functions.
-                        loss = loss_fn(label, output["prediction"], dtm, alpha)
-                    elif self.mist_arguments.loss in ["cldice"]:
-                        # Use the alpha parameter to weight the cldice and
-                        # dice with cross entropy loss functions.
-                        loss = loss_fn(label, output["prediction"], alpha)
-                    else:
-                        # Use only the image and label for other loss functions
-                        # like dice with cross entropy.
-                        loss = loss_fn(label, output["prediction"])
-
-                    # If deep supervision is enabled, compute the additional
-                    # losses from the deep supervision heads. Deep supervision
-                    # provides additional output layers that guide the model
-                    # during training by supplying intermediate supervision
-                    # signals at various stages of the model.
-
-                    # We scale the loss from each deep supervision head by a
-                    # factor of (0.5 ** (k + 1)), where k is the index of the
-                    # deep supervision head. This creates a geometric series
-                    # that gives decreasing weight to deeper (later) supervision
-                    # heads. The idea is to ensure that the loss from earlier
-                    # heads (closer to the final output) contributes more to the
-                    # total loss, while still incorporating the information from
-                    # later heads.
-
-                    # After summing the losses from all deep supervision heads,
-                    # we normalize the total loss using a correction factor
-                    # (c_norm). This factor is derived from the sum of the
-                    # geometric series (1 / (2 - 2 ** -(n+1))), where n is the
-                    # number of deep supervision heads. The normalization
-                    # ensures that the total loss isn't biased or dominated by
-                    # the deep supervision losses.
-                    if self.mist_arguments.deep_supervision:
-                        for k, p in enumerate(output["deep_supervision"]):
-                            # Apply the loss function based on the model's
-                            # configuration. If distance transform maps
-                            # are used, pass them to the loss function.
-                            if self.mist_arguments.use_dtms:
-                                loss += 0.5 ** (k + 1) * loss_fn(
-                                    label, p, dtm, alpha
-                                )
-                            # If cldice loss is used, pass alpha to the loss
-                            # function.
-                            elif self.mist_arguments.loss in ["cldice"]:
-                                loss += 0.5 ** (k + 1) * loss_fn(
-                                    label, p, alpha
-                                )
-                            # Otherwise, compute the loss normally.
-                            else:
-                                loss += 0.5 ** (k + 1) * loss_fn(label, p)
-
-                        # Normalize the total loss from deep supervision heads
-                        # using a correction factor to prevent it from
-                        # dominating the main loss.
-                        c_norm = 1 / (2 - 2 ** -(
-                            len(output["deep_supervision"]) + 1
-                            )
-                        )
-                        loss *= c_norm
-
-                    # Check if Variational Autoencoder (VAE) regularization
-                    # is enabled. VAE regularization encourages the model to
-                    # learn a latent space that follows a normal
-                    # distribution, which helps the model generalize better.
-                    # This term adds a penalty to the loss, based on how much
-                    # the learned latent space deviates from the expected
-                    # distribution (usually Gaussian). We then sample from this
-                    # latent space to reconstruct the input image. The total VAE
-                    # loss is the sum of the Kullback-Leibler (KL) divergence
-                    # and the reconstruction loss.
-                    if self.mist_arguments.vae_reg:
-                        vae_loss = self.fixed_loss_functions["vae"](
-                            image, output["vae_reg"]
-                        )
-                        # Multiply the computed VAE loss by a scaling
-                        # factor, vae_penalty, which controls the strength of
-                        # the regularization.
-                        loss += self.mist_arguments.vae_penalty * vae_loss
-
-
-                    # L2 regularization term. This term adds a penalty to the
-                    # loss based on the L2 norm of the model's parameters.
-                    if self.mist_arguments.l2_reg:
-                        l2_norm_of_model_parameters = 0.0
-                        for param in model.parameters():
-                            l2_norm_of_model_parameters += (
-                                torch.norm(param, p=2)
-                            )
-
-                        # Update the loss with the L2 regularization term scaled
-                        # by the l2_penalty parameter.
-                        loss += (
-                            self.mist_arguments.l2_penalty *
-                            l2_norm_of_model_parameters
-                        )
-
-                    # L1 regularization term. This term adds a penalty to the
-                    # loss based on the L1 norm of the model's parameters.
-                    if self.mist_arguments.l1_reg:
-                        l1_norm_of_model_parameters = 0.0
-                        for param in model.parameters():
-                            l1_norm_of_model_parameters += (
-                                torch.norm(param, p=1)
-                            )
-
-                        # Update the loss with the L1 regularization term scaled
-                        # by the l1_penalty parameter.
-                        loss += (
-                            self.mist_arguments.l1_penalty *
-                            l1_norm_of_model_parameters
-                        )
-                    return loss
+                    return loss_functions.compose_loss(
+                        model=model,
+                        image=image,
+                        label=label,
+                        dtm=dtm,
+                        alpha=alpha,
+                        loss_fn=loss_fn,
+                        config=loss_config,
+                        vae_loss_fn=self.fixed_loss_functions["vae"],
+                        params=trainable_params,
+                    )
 
                 # Zero out the gradients from the previous batch.
                 # Gradients accumulate by default in PyTorch, so it's important
                 # to reset them at the start of each training iteration to avoid
-                # interference from prior batches.
-                optimizer.zero_grad()
+                # interference from prior batches. Setting the gradients to
+                # None instead of zero avoids a memset for every parameter.
+                optimizer.zero_grad(set_to_none=True)
 
                 # Check if automatic mixed precision (AMP) is enabled for this
                 # training step.
                 if self.mist_arguments.amp:
                     # AMP is used to speed up training and reduce memory usage
                     # by performing certain operations in lower precision
-                    # (e.g., float16). This can improve the efficiency of
-                    # training on GPUs without significant loss in accuracy.
+                    # (e.g., float16 or bfloat16). This can improve the
+                    # efficiency of training on GPUs without significant loss in
+                    # accuracy.
 
                     # Use `torch.autocast` to automatically handle mixed
                     # precision operations on the GPU. This context manager
-                    # ensures that certain operations are performed in float16
+                    # ensures that certain operations are performed in lower
                     # precision while others remain in float32, depending
                     # on what is most efficient and appropriate.
-                    with torch.autocast(
-                        device_type="cuda", dtype=torch.float16
-                    ):
+                    with torch.autocast(device_type="cuda", dtype=amp_dtype):
                         # Perform the forward pass and compute the loss using
                         # mixed precision.
                         loss = compute_loss()
+                else:
+                    # If AMP is not enabled, perform the forward pass and
+                    # compute the loss using float32 precision.
+                    loss = compute_loss()
 
+                # The gradient scaler is only used with float16 AMP.
+                if amp_gradient_scaler is not None:
                     # Backward pass: Compute gradients by scaling the loss to
                     # prevent underflow. Scaling is necessary when using AMP
                     # because very small gradients in float16 could underflow
@@ -639,7 +783,7 @@ class Trainer:
                         # Clip gradients to the maximum norm (clip_norm_max) to
                         # stabilize training.
                         torch.nn.utils.clip_grad_norm_(
-                            model.parameters(),
+                            trainable_params,
                             self.mist_arguments.clip_norm_max
                         )
 
@@ -654,17 +798,13 @@ class Trainer:
                     # factor dynamically based on whether gradients overflow.
                     amp_gradient_scaler.update()
                 else:
-                    # If AMP is not enabled, perform the forward pass and
-                    # compute the loss using float32 precision.
-                    loss = compute_loss()
-
                     # Compute the loss and its gradients.
                     loss.backward()
 
                     # Apply gradient clipping if enabled.
                     if self.mist_arguments.clip_norm:
                         torch.nn.utils.clip_grad_norm_(
-                            model.parameters(),
+                            trainable_params,
                             self.mist_arguments.clip_norm_max
                         )
 
@@ -685,22 +825,116 @@ class Trainer:
                 Returns:
                     loss: Loss value for the batch.
                 """
-                pred = sliding_window_inference(
-                    image,
-                    roi_size=(
-                        self.data_structures["mist_configuration"][
-                            "patch_size"
-                        ]
-                    ),
-                    overlap=self.mist_arguments.val_sw_overlap,
-                    sw_batch_size=1,
-                    predictor=model,
-                    device=torch.device("cuda")
+                def predictor(window: torch.Tensor) -> torch.Tensor:
+                    """Predict on a single window in the model's layout.
+
+                    Sliding window inference crops windows from the full image,
+                    so we convert each window to the memory format of the model
+                    instead of the whole image.
+
+                    Args:
+                        window: Batch of windows cropped from the image.
+
+                    Returns:
+                        Model output for the batch of windows.
+                    """
+                    return model(
+                        window.contiguous(memory_format=input_memory_format)
+                        if channels_last else window
+                    )
+
+                # Use the same mixed precision settings as training for the
+                # forward passes of the sliding window inference. No gradient
+                # scaling is needed since there is no backward pass. We run
+                # several windows per forward pass and cache the blending weight
+                # map, which is the same for every window since the patch size
+                # is fixed. The output stays on the GPU because the validation
+                # loss needs the full logits.
+                with torch.autocast(
+                    device_type="cuda",
+                    dtype=amp_dtype,
+                    enabled=self.mist_arguments.amp,
+                ):
+                    pred = sliding_window_inference(
+                        image,
+                        roi_size=(
+                            self.data_structures["mist_configuration"][
+                                "patch_size"
+                            ]
+                        ),
+                        overlap=self.mist_arguments.val_sw_overlap,
+                        sw_batch_size=self.mist_arguments.val_sw_batch_size,
+                        predictor=predictor,
+                        mode=self.mist_arguments.blend_mode,
+                        cache_roi_weight_map=True,
+                        device=torch.device("cuda")
+                    )
+
+                # Compute the validation loss in full precision.
+                return self.fixed_loss_functions["validation"](
+                    label, pred.float()
                 )
 
-                return self.fixed_loss_functions["validation"](label, pred)
+            # Losses are sent to device 0 with asynchronous reductions. We keep
+            # at most two reductions in flight and only wait on the oldest one,
+            # so the host does not block on the GPU after every step.
+            pending_losses = collections.deque(maxlen=2)
+
+            def wait_for_oldest_loss(
+                    pending: Deque[Tuple[dist.Work, torch.Tensor]],
+                    running_mean: Optional[utils.RunningMean],
+                    pb: Optional[
+                        Union[
+                            progress_bar.TrainProgressBar,
+                            progress_bar.ValidationProgressBar,
+                        ]
+                    ],
+            ) -> Optional[float]:
+                """Wait for the oldest pending loss and update the running loss.
+
+                Only the first process (i.e., rank 0) receives the reduced loss,
+                so all other processes only wait for their reduction to finish.
+
+                Args:
+                    pending: Queue of pending reductions and their losses.
+                    running_mean: Running mean of the loss, or None if this is
+                        not the first process.
+                    pb: Progress bar to update with the running loss, or None
+                        if this is not the first process.
 
-            patch_counter=0
+                Returns:
+                    running_loss: Updated running loss, or None if this is not
+                        the first process.
+                """
+                # Wait for the reduction to finish.
+                handle, reduced_loss = pending.popleft()
+                handle.wait()
+                if rank != 0:
+                    return None
+
+                # Average the loss across all GPUs.
+                running_loss = running_mean(reduced_loss.item() / world_size)
+
+                # Update the progress bar with the running loss.
+                pb.update(loss=running_loss)
+                return running_loss
+
+            # Set up background writer for debugging patches if enabled. We
+            # write patches from a separate thread so that disk I/O does not
+            # block training. Only the first process (i.e., rank 0) writes
+            # patches.
+            debug_dump_patches = (
+                rank == 0 and self.mist_arguments.debug_dump_patches > 0
+            )
+            if debug_dump_patches:
+                debug_patch_counter = 0
+                debug_patch_writer = (
+                    concurrent.futures.ThreadPoolExecutor(max_workers=1)
+                )
+                debug_patch_dir = os.path.join(
+                    self.mist_arguments.results, "debug_patches", f"fold_{fold}"
+                )
+                os.makedirs(debug_patch_dir, exist_ok=True)
 
             # Train the model for the specified number of epochs.
             for epoch in range(self.mist_arguments.epochs):
@@ -708,98 +942,93 @@ class Trainer:
                 # training data.
                 model.train(True)
 
-                # Only log metrics on first process (i.e., rank 0).
+                # Compute alpha for boundary loss functions. The alpha parameter
+                # is used to weight the boundary loss function with a
+                # region-based loss function like dice or cross entropy. Alpha
+                # only changes between epochs, so we compute it once per epoch
+                # and keep it on the GPU as a 0-D tensor. This avoids creating a
+                # new constant on the GPU every step and lets torch.compile
+                # treat alpha as an input instead of recompiling when its value
+                # changes.
+                alpha = torch.tensor(
+                    self.boundary_loss_weighting_schedule(epoch),
+                    dtype=torch.float32,
+                    device=rank,
+                )
+
+                # Only display the progress bar on the first process (i.e.,
+                # rank 0). All other processes run the same loop without it.
                 if rank == 0:
-                    ## with progress_bar.TrainProgressBar(
-                    ##     epoch + 1,
-                    ##     fold,
-                    ##     self.mist_arguments.epochs,
-                    ##     self.mist_arguments.steps_per_epoch
-                    ## ) as pb:
-                        for _ in range(self.mist_arguments.steps_per_epoch):
-                            if patch_counter >=50:
-                                break
-                            # Get data from training loader.
-                            data = train_loader.next()[0] #comment out to run with and without augmentation
-                            mylbl = data["label"].detach().cpu().numpy()
-                            myimg = data["image"].detach().cpu().numpy()
-                            print("myimg.shape", myimg.shape)
-                            import ants
-                            ants.image_write(ants.from_numpy(myimg[patch_counter % myimg.shape[0], 0, :, :, :]), f'myimage{patch_counter:02}_00.nii.gz')
-                            #ants.image_write(ants.from_numpy(myimg[patch_counter % myimg.shape[0], 1, :, :, :]), f'myimage{patch_counter:02}_01.nii.gz')
-                            #ants.image_write(ants.from_numpy(mylbl[patch_counter % mylbl.shape[0], 0, :, :, :]), f'mylabel{patch_counter:02}_0.nii.gz') 
-                            #ants.image_write(ants.from_numpy(myimg[0,0,:,:,:]), 'myimage00.nii.gz')
-                            #ants.image_write(ants.from_numpy(myimg[0,1,:,:,:]), 'myimage01.nii.gz')
-                            #ants.image_write(ants.from_numpy(myimg[1,0,:,:,:]), 'myimage10.nii.gz')
-                            #ants.image_write(ants.from_numpy(myimg[1,1,:,:,:]), 'myimage11.nii.gz')
-                            #ants.image_write(ants.from_numpy(mylbl[0,0,:,:,:]), 'mylabel0.nii.gz')
-                            #ants.image_write(ants.from_numpy(mylbl[1,0,:,:,:]), 'mylabel1.nii.gz')
-                            if myimg.shape[1] > 1:
-                                ants.image_write(ants.from_numpy(myimg[patch_counter % myimg.shape[0], 1, :, :, :]), f'myimage{patch_counter:02}_01.nii.gz')
-                                
-                            ants.image_write(ants.from_numpy(mylbl[patch_counter % mylbl.shape[0], 0, :, :, :]), f'mylabel{patch_counter:02}_0.nii.gz')
-                            patch_counter +=1 
-                
-                if patch_counter >= 50:
-                    break 
-                
-            import ipdb; ipdb.set_trace()     
-
-                            # Compute alpha for boundary loss functions. The
-                            # alpha parameter is used to weight the boundary
-                            # loss function with a region-based loss function
-                            # like dice or cross entropy.
-                            
-        alpha = self.boundary_loss_weighting_schedule(epoch)
-        if self.mist_arguments.use_dtms:
-                                # Use distance transform maps for boundary-based
-                                # loss functions. In this case, we pass them
-                                # and the alpha parameter to the train_step.
-                                image, label, dtm = (
-                                    data["image"], data["label"], data["dtm"]
-                                )
+                    train_progress_bar = progress_bar.TrainProgressBar(
+                        epoch + 1,
+                        fold,
+                        self.mist_arguments.epochs,
+                        self.mist_arguments.steps_per_epoch
+                    )
+                else:
+                    train_progress_bar = contextlib.nullcontext()
 
-                                # Perform a single training step. Return
-                                # the loss for the batch.
-                                loss = train_step(image, label, dtm, alpha)
-        else:
-                                # If distance transform maps are not used, pass
-                                # None for the dtm parameter. If we are using
-                                # cldice loss, pass the alpha parameter to the
-                                # train_step. Otherwise, pass None.
-                                image, label = data["image"], data["label"]
-                                if self.mist_arguments.loss in ["cldice"]:
-                                    loss = train_step(image, label, None, alpha)
-                                else:
-                                    loss = train_step(image, label, None, None)
-
-                            # Update update the learning rate scheduler.
-        learning_rate_scheduler.step()
-
-                            # Send all training losses to device 0 to add them.
-        dist.reduce(loss, dst=0)
-
-                            # Average the loss across all GPUs.
-        current_loss = loss.item() / world_size
-
-                            # Update the running loss for the progress bar.
-        running_loss = running_loss_train(current_loss)
-
-                            # Update the progress bar with the running loss.
-        pb.update(loss=running_loss)
-        #else:
-                    # For all other processes, do not display the progress bar.
-                    # Repeat the training steps shown above for the other GPUs.
-        for _ in range(self.mist_arguments.steps_per_epoch):
+                with train_progress_bar as pb:
+                    for _ in range(self.mist_arguments.steps_per_epoch):
                         # Get data from training loader.
                         data = train_loader.next()[0]
-                        alpha = self.boundary_loss_weighting_schedule(epoch)
+
+                        # Write training patches to disk for debugging if
+                        # enabled. We copy a single patch from the batch to
+                        # pinned host memory without blocking and write it in
+                        # the background once the copy is done.
+                        if (
+                            debug_dump_patches and
+                            debug_patch_counter <
+                            self.mist_arguments.debug_dump_patches
+                        ):
+                            batch_index = (
+                                debug_patch_counter % data["image"].shape[0]
+                            )
+                            image_host = torch.empty_like(
+                                data["image"][batch_index],
+                                device="cpu",
+                                pin_memory=True,
+                            )
+                            image_host.copy_(
+                                data["image"][batch_index], non_blocking=True
+                            )
+                            label_host = torch.empty_like(
+                                data["label"][batch_index],
+                                device="cpu",
+                                pin_memory=True,
+                            )
+                            label_host.copy_(
+                                data["label"][batch_index], non_blocking=True
+                            )
+                            copy_done = torch.cuda.Event()
+                            copy_done.record()
+                            debug_patch_writer.submit(
+                                self._write_debug_patch,
+                                image_host,
+                                label_host,
+                                copy_done,
+                                debug_patch_dir,
+                                debug_patch_counter,
+                            )
+                            debug_patch_counter += 1
+
                         if self.mist_arguments.use_dtms:
+                            # Use distance transform maps for boundary-based
+                            # loss functions. In this case, we pass them and
+                            # the alpha parameter to the train_step.
                             image, label, dtm = (
                                 data["image"], data["label"], data["dtm"]
                             )
+
+                            # Perform a single training step. Return the loss
+                            # for the batch.
                             loss = train_step(image, label, dtm, alpha)
                         else:
+                            # If distance transform maps are not used, pass
+                            # None for the dtm parameter. If we are using
+                            # cldice loss, pass the alpha parameter to the
+                            # train_step. Otherwise, pass None.
                             image, label = data["image"], data["label"]
                             if self.mist_arguments.loss in ["cldice"]:
                                 loss = train_step(image, label, None, alpha)
@@ -809,43 +1038,82 @@ class Trainer:
                         # Update the learning rate scheduler.
                         learning_rate_scheduler.step()
 
-                        # Send the loss on the current GPU to device 0.
-                        dist.reduce(loss, dst=0)
+                        # Send all training losses to device 0 to add them.
+                        # The reduction runs asynchronously so that the next
+                        # step can start before the loss reaches the host.
+                        pending_losses.append(
+                            (
+                                dist.reduce(
+                                    loss.detach(), dst=0, async_op=True
+                                ),
+                                loss.detach(),
+                            )
+                        )
+
+                        # Update the progress bar with the oldest pending loss
+                        # once the queue is full. This keeps at most one step
+                        # in flight.
+                        if len(pending_losses) == pending_losses.maxlen:
+                            running_loss = wait_for_oldest_loss(
+                                pending_losses, running_loss_train, pb
+                            )
+
+                    # Update the progress bar with the remaining losses.
+                    while pending_losses:
+                        running_loss = wait_for_oldest_loss(
+                            pending_losses, running_loss_train, pb
+                        )
 
                 # Wait for all processes to finish the epoch.
-        dist.barrier()
+                dist.barrier()
 
                 # Start validation. We don't need gradients on to do reporting.
-        model.eval()
-        with torch.no_grad():
-                    # Only log metrics on first process (i.e., rank 0).
+                model.eval()
+                with torch.no_grad():
+                    # Only display the progress bar on the first process (i.e.,
+                    # rank 0).
                     if rank == 0:
-                        with progress_bar.ValidationProgressBar(
-                            val_steps
-                        ) as pb:
-                            for _ in range(val_steps):
-                                # Get data from validation loader.
-                                data = validation_loader.next()[0]
-                                image, label = data["image"], data["label"]
-
-                                # Compute loss for single validation step.
-                                val_loss = val_step(image, label)
-
-                                # Send all validation losses to device 0 to add
-                                # them.
-                                dist.reduce(val_loss, dst=0)
-
-                                # Average the loss across all GPUs.
-                                current_val_loss = val_loss.item() / world_size
-
-                                # Update the running loss for the progress bar.
-                                running_val_loss = running_loss_validation(
-                                    current_val_loss
+                        validation_progress_bar = (
+                            progress_bar.ValidationProgressBar(val_steps)
+                        )
+                    else:
+                        validation_progress_bar = contextlib.nullcontext()
+
+                    with validation_progress_bar as pb:
+                        for _ in range(val_steps):
+                            # Get data from validation loader.
+                            data = validation_loader.next()[0]
+                            image, label = data["image"], data["label"]
+
+                            # Compute loss for single validation step.
+                            val_loss = val_step(image, label)
+
+                            # Send all validation losses to device 0 to add
+                            # them.
+                            pending_losses.append(
+                                (
+                                    dist.reduce(
+                                        val_loss, dst=0, async_op=True
+                                    ),
+                                    val_loss,
+                                )
+                            )
+
+                            # Update the progress bar with the oldest pending
+                            # loss once the queue is full.
+                            if len(pending_losses) == pending_losses.maxlen:
+                                running_val_loss = wait_for_oldest_loss(
+                                    pending_losses, running_loss_validation, pb
                                 )
 
-                                # Update the progress bar with the running loss.
-                                pb.update(loss=running_val_loss)
+                        # Update the progress bar with the remaining losses.
+                        while pending_losses:
+                            running_val_loss = wait_for_oldest_loss(
+                                pending_losses, running_loss_validation, pb
+                            )
 
+                    # Only save models on the first process (i.e., rank 0).
+                    if rank == 0:
                         # Check if validation loss is lower than the current
                         # best validation loss. If so, save the model.
                         if running_val_loss < best_validation_loss:
@@ -860,8 +1128,14 @@ class Trainer:
                             # Update the current best validation loss.
                             best_validation_loss = running_val_loss
 
-                            # Save the model with the best validation loss.
-                            torch.save(model.state_dict(), best_model_name)
+                            # Save the model with the best validation loss. If
+                            # the model is compiled, save the state dictionary
+                            # of the original model so that the weights do not
+                            # carry the prefix added by torch.compile.
+                            torch.save(
+                                getattr(model, "_orig_mod", model).state_dict(),
+                                best_model_name
+                            )
                         else:
                             # Otherwise, log that the validation loss did not
                             # improve and display the best validation loss.
@@ -871,27 +1145,14 @@ class Trainer:
                                 f"{best_validation_loss:.4}\n"
                             )
                             console.print(text)
-                    else:
-                        # Repeat the validation steps for the other GPUs. Do
-                        # not display the progress bar for these GPUs.
-                        for _ in range(val_steps):
-                            # Get data from validation loader.
-                            data = validation_loader.next()[0]
-                            image, label = data["image"], data["label"]
-
-                            # Compute loss for single validation step.
-                            val_loss = val_step(image, label)
-
-                            # Send the loss on the current GPU to device 0.
-                            dist.reduce(val_loss, dst=0)
 
                 # Reset training and validation loaders after each epoch.
-        train_loader.reset()
-        validation_loader.reset()
+                train_loader.reset()
+                validation_loader.reset()
 
                 # Log the running loss for training and validation after each
                 # epoch. Only log metrics on first process (i.e., rank 0).
-        if rank == 0:
+                if rank == 0:
                     # Log the running loss for validation.
                     summary_data = {
                         "Training": running_loss,
@@ -909,13 +1170,17 @@ class Trainer:
                     running_loss_validation.reset_states()
 
             # Wait for all processes to finish the fold.
-        dist.barrier()
+            dist.barrier()
 
             # Close the tensorboard summary writer after each fold. Only
             # close the writer on the first process (i.e., rank 0).
-        if rank == 0:
+            if rank == 0:
                 writer.close()
 
+            # Wait for any pending debugging patches to be written.
+            if debug_dump_patches:
+                debug_patch_writer.shutdown(wait=True)
+
         # Clean up processes after distributed training.
         self.cleanup()
 
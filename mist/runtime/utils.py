@@ -1,12 +1,13 @@
 """Utility functions for MIST."""
 import json
+import logging
 import os
 import glob
 import random
 import argparse
 import subprocess
 import warnings
-from typing import Any, Dict, Tuple, List, Callable
+from typing import Any, Dict, Tuple, List, Callable, Iterable
 
 import ants
 import numpy as np
@@ -16,11 +17,18 @@ import SimpleITK as sitk
 import skimage
 import torch
 from torch import nn
+from rich.console import Console
 from rich.progress import (BarColumn, MofNCompleteColumn, Progress, TextColumn,
                            TimeElapsedColumn)
 from scipy import ndimage
 from sklearn.model_selection import KFold
 
+# Use orjson for faster JSON parsing if it is installed.
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 
 def read_json_file(json_file: str) -> Dict[str, Any]:
     """Read json file and output it as a dictionary.
@@ -31,8 +39,18 @@ def read_json_file(json_file: str) -> Dict[str, Any]:
     Returns:
         json_data: Dictionary with json file data.
     """
-    with open(json_file, "r", encoding="utf-8") as file:
-        json_data = json.load(file)
+    if orjson is not None:
+        with open(json_file, "rb") as file:
+            json_bytes = file.read()
+        try:
+            json_data = orjson.loads(json_bytes)
+        except orjson.JSONDecodeError:
+            # orjson rejects the NaN and Infinity literals that json.dump
+            # writes by default, so fall back to the standard library parser.
+            json_data = json.loads(json_bytes)
+    else:
+        with open(json_file, "r", encoding="utf-8") as file:
+            json_data = json.load(file)
     return json_data
 
 
@@ -225,7 +243,7 @@ def has_test_data(dataset_json_path: str) -> bool:
 def get_numpy_file_paths_list(
         base_dir: str,
         folder: str,
-        patient_ids: List[str]
+        patient_ids: Iterable[str]
 ) -> List[str]:
     """Create a list of file paths for each patient ID.
 
@@ -236,7 +254,7 @@ def get_numpy_file_paths_list(
         base_dir: Base directory for the dataset.
         folder: Subdirectory within the base directory for images, labels, or
             DTMs.
-        patient_ids: List of patient IDs.
+        patient_ids: List or array of patient IDs.
 
     Returns:
         List of file paths corresponding to each patient ID.
@@ -492,6 +510,72 @@ def get_optimizer(
     )
 
 
+def get_amp_dtype(amp_dtype: str) -> torch.dtype:
+    """Get the data type for automatic mixed precision based on user input.
+
+    Args:
+        amp_dtype: Data type for AMP. Options are "fp16", "bf16", or "auto".
+            With "auto", we use bfloat16 if the current GPU supports it (i.e.,
+            Ampere or newer) and float16 otherwise.
+
+    Returns:
+        Torch data type to use with torch.autocast.
+
+    Raises:
+        ValueError: If the AMP data type is not recognized.
+    """
+    if amp_dtype == "fp16":
+        return torch.float16
+    if amp_dtype == "bf16":
+        return torch.bfloat16
+    if amp_dtype == "auto":
+        return (
+            torch.bfloat16 if torch.cuda.is_bf16_supported() else torch.float16
+        )
+    raise ValueError(f"Received invalid AMP data type {amp_dtype}.")
+
+
+class _CompileFallbackWarningHandler(logging.Handler):
+    """Print a single warning when torch.compile falls back to eager mode.
+
+    TorchDynamo logs a warning each time it cannot compile a frame (or hits the
+    recompilation cache limit) and runs it eagerly instead. This handler turns
+    the first of these into one short message so that the fallback is visible.
+    """
+    def __init__(self):
+        super().__init__(level=logging.WARNING)
+        self.warned = False
+
+    def emit(self, record: logging.LogRecord) -> None:
+        if not self.warned:
+            self.warned = True
+            Console().print(
+                "[bold yellow]Warning:[/bold yellow] torch.compile could not "
+                "compile part of the model and is running it eagerly. See the "
+                "torch._dynamo logs for details."
+            )
+
+
+def enable_compile_eager_fallback(warn: bool) -> None:
+    """Run frames that torch.compile cannot compile eagerly.
+
+    Errors during compilation are suppressed so that training or inference
+    continue without compilation for the affected frames.
+
+    Args:
+        warn: Print a single warning the first time a frame falls back to eager
+            mode. Only enable this on one process (i.e., rank 0).
+    """
+    torch._dynamo.config.suppress_errors = True
+    if warn:
+        logger = logging.getLogger("torch._dynamo.convert_frame")
+        if not any(
+            isinstance(handler, _CompileFallbackWarningHandler)
+            for handler in logger.handlers
+        ):
+            logger.addHandler(_CompileFallbackWarningHandler())
+
+
 class RunningMean(nn.Module):
     """Simple moving average module for loss tracking.
 
@@ -1035,6 +1119,8 @@ def make_onehot(
 ) -> List[sitk.Image]:
     """Convert a multi-class ANTs image into a list of binary sitk images.
 
+    The binary images are stored as uint8 to keep their memory footprint small.
+
     Args:
         mask_ants: ANTs image object.
         labels_list: List of unique labels to create binary masks for.
@@ -1051,7 +1137,7 @@ def make_onehot(
     masks_sitk = []
     for current_label in labels_list:
         sitk_label_i = sitk.GetImageFromArray(
-            (mask_npy == current_label).T.astype("float32")
+            (mask_npy == current_label).T.astype("uint8")
         )
         sitk_label_i.SetSpacing(spacing)
         sitk_label_i.SetOrigin(origin)